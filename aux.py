@@ -6,73 +6,97 @@
 
 import datetime as dt
 
+import numpy as np
+import pandas as pd
+
+
+_MONDAY_EPOCH=dt.date(1,1,1).toordinal()-dt.date(1,1,1).weekday() #28d periods are counted from this Monday
+_MONDAY_EPOCH_NP=np.datetime64(dt.date.fromordinal(_MONDAY_EPOCH),'D')
+
 
 def period_7d(date):
     x=dt.date.isocalendar(date)
     return str(x[0])+'-w{:02d}'.format(x[1])
 
 def period_28d(date):
-    x=dt.date.isocalendar(date)
-    return str(x[0])+'-28d-'+str(x[1]//4+1)
+    x=dt.date.isocalendar(representative_28d(date))
+    return str(x[0])+'-28d-'+str((x[1]-1)//4+1)
+
+
+_DAY_TO_WEEK=(None,)+('w1',)*7+('w2',)*7+('w3',)*7+('w4',)*6+('w5',)*4 #indexed by date.day
+_MONTH_TO_Q=(None,)+('q1',)*3+('q2',)*3+('q3',)*3+('q4',)*3 #indexed by date.month
 
 
 def period_w(date):
-    x=date.strftime("%Y-%m/%d").split('/')
-    day=date.day
-    if day<8:
-        return x[0]+'-'+'w1'
-    elif day<15:
-        return x[0]+'-'+'w2'
-    elif day<22:
-        return x[0]+'-'+'w3'
-    elif day<28:
-        return x[0]+'-'+'w4'
-    else:
-        return x[0]+'-'+'w5'
+    return f'{date.year:04d}-{date.month:02d}-{_DAY_TO_WEEK[date.day]}'
     
 def period_q(date):
-    x=date.strftime("%Y/%m").split('/')
-    month=date.month
-    if month<4:
-        return x[0]+'-'+'q1'
-    elif month<7:
-        return x[0]+'-'+'q2'
-    elif month<10:
-        return x[0]+'-'+'q3'
-    else:
-        return x[0]+'-'+'q4'
+    return f'{date.year:04d}-{_MONTH_TO_Q[date.month]}'
 
 def period_d(date):
-    return date.strftime("%Y-%m-%d")
+    return f'{date.year:04d}-{date.month:02d}-{date.day:02d}'
 
 def period_m(date):
-    return date.strftime("%Y-%m")
+    return f'{date.year:04d}-{date.month:02d}'
+
+_PERIODS={'7d':period_7d,'28d':period_28d,'w':period_w,'m':period_m,'d':period_d,'q':period_q}
 
 def custom_period(tipo,date):
-    if tipo=='7d':
-        return period_7d(date)
-    elif tipo=='28d':
-        return period_28d(date)
-    elif tipo=='w':
-        return period_w(date)
-    elif tipo=='m':
-        return period_m(date)
-    elif tipo=='d':
-        return period_d(date)
-    elif tipo=='q':
-        return period_q(date)
+    return _PERIODS[tipo](date)
     
     
+def representative_7d(date):
+    iso=dt.date.isocalendar(date)
+    return dt.datetime.strptime('{:04d} {:02d} 1'.format(iso[0],iso[1]), '%G %V %u').date()
+
+def representative_28d(date):
+    n=(date.toordinal()-_MONDAY_EPOCH)//28
+    return dt.date.fromordinal(_MONDAY_EPOCH+n*28)
+
+def representative_m(date):
+    return dt.date(date.year,date.month,1)
+
+def representative_d(date):
+    return date
+
+def representative_q(date):
+    return dt.date(date.year,(date.month-1)//3*3+1,1)
+
+_REPRESENTATIVES={'7d':representative_7d,'28d':representative_28d,'m':representative_m,'d':representative_d,'q':representative_q}
+
 def custom_representative(tipo,date): #date not datetime
-    if tipo=='7d':
-        iso=dt.date.isocalendar(date)
-        return dt.datetime.strptime('{:04d} {:02d} 1'.format(iso[0],iso[1]), '%G %V %u').date()
+    return _REPRESENTATIVES[tipo](date)
+
+
+def series_representative(tipo,dates): #vectorized custom_representative for a whole column
+    s=pd.to_datetime(dates)
+    if s.dt.tz is not None: #keep the wall-clock time, .values would convert it to UTC
+        s=s.dt.tz_localize(None)
+    if tipo=='m':
+        return s.values.astype('datetime64[M]').astype('datetime64[ns]')
+    elif tipo=='q':
+        months=s.values.astype('datetime64[M]') #local months, s has no tz here
+        return (months-months.astype(np.int64)%3).astype('datetime64[ns]') #NaT stays NaT
+    elif tipo=='d':
+        return s.dt.normalize().values
+    elif tipo=='7d':
+        return (s.dt.normalize()-pd.to_timedelta(s.dt.weekday,unit='D')).values
     elif tipo=='28d':
-        iso=dt.date.isocalendar(date)
-        return dt.datetime.strptime('{:04d} {:02d} 1'.format(iso[0],iso[1]//4*4 if iso[1]//4!=0 else 1), '%G %V %u').date()
-    elif tipo=='m':
-        return dt.date(date.year,date.month,1)
+        days=s.values.astype('datetime64[D]') #local days, s has no tz here
+        return (days-(days-_MONDAY_EPOCH_NP)%np.timedelta64(28,'D')).astype('datetime64[ns]') #NaT stays NaT
+
+
+def series_period(tipo,dates): #vectorized custom_period for a whole column
+    s=pd.to_datetime(dates)
+    if tipo=='m':
+        return s.dt.strftime('%Y-%m')
     elif tipo=='d':
-        return date
+        return s.dt.strftime('%Y-%m-%d')
     elif tipo=='q':
-        return dt.date(date.year,date.month//3*3 if date.month//3!=0 else 1,1)
\ No newline at end of file
+        return s.dt.year.astype(str)+'-q'+((s.dt.month-1)//3+1).astype(str)
+    elif tipo=='7d':
+        iso=s.dt.isocalendar()
+        return iso['year'].astype(str)+'-w'+iso['week'].astype(str).str.zfill(2)
+    elif tipo=='28d':
+        iso=pd.Series(series_representative(tipo,s),index=s.index).dt.isocalendar()
+        return iso['year'].astype(str)+'-28d-'+((iso['week']-1)//4+1).astype(str)
@@ -10,29 +10,8 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import datetime as dt
 
-from copy import deepcopy
-
 from aux import *
 
-def nums(data):
-    data['period_num']=np.arange(len(data))
-    #data['months']=data['months'].apply(lambda x: '+{:02}'.format(x))
-    return data
-
-def perc(data,name,column,column2=None):
-    if not column2:
-        column2=column
-    data[name]=data[column]/data[column2].iloc[0]
-    return data
-
-def churn(data,name,column):
-    data[name]=data[column].iloc[0]-data[column]
-    return data
-
-def accum(data,name,column):
-    data[name]=data[column].cumsum()
-    return data
-
 class Cohorts(object):
     """
     Cohorts is an object implementation of the Cohorts Framework. The framework
@@ -76,6 +55,8 @@ class Cohorts(object):
     
     column_date : the string input in fit (see fit function)
     
+    column_input : the string input in fit or 'column_input' if simple (see fit function)
+    
     arguments : list of strings
         All the ways the model has been fitted and we can have a cohort representation on them.
         It include both standard and personalized ways, but it doesn't include the percentage
@@ -121,6 +102,87 @@ class Cohorts(object):
             
         self.simple=simple
         self.arguments=[]
+        self._base={}
+        self._cohort_gb=None
+        self._pivot_cache={}
+        self._pivot_source=None
+        
+    def _gb_cohort(self):
+        """
+        Returns 'df_cohorts' grouped by cohort. The GroupBy is cached and only rebuilt when
+        'df_cohorts' is replaced by a new DataFrame, because adding columns in place doesn't
+        change the groups.
+        """
+        if self._cohort_gb is None or self._cohort_gb.obj is not self.df_cohorts:
+            self._cohort_gb=self.df_cohorts.groupby('cohort',sort=False,observed=True)
+        return self._cohort_gb
+        
+    def _pivot(self,label,way):
+        """
+        Returns the cohort matrix of the label by the way given, shared by 'transform_pd',
+        'transform_np' and the plots. The pivots are cached until 'df_cohorts' is replaced by a
+        new DataFrame or an apply function adds columns to it, so they must not be modified.
+        """
+        if self._pivot_source is not self.df_cohorts:
+            self._pivot_cache={}
+            self._pivot_source=self.df_cohorts
+        df_cohorts=self._pivot_cache.get((label,way))
+        if df_cohorts is None:
+            df_cohorts=self.df_cohorts.set_index(['cohort',way])[[label]].unstack()
+            self._pivot_cache[(label,way)]=df_cohorts
+        return df_cohorts
+        
+    def _materialize_base(self,column_input=None,column_id=None):
+        """
+        Calculate 'total' on 'column_input' and 'unique_users' on 'column_id' by cohort and period,
+        and their percentages. A column is skipped if its input is None or if it's already on
+        'df_cohorts' computed from the same input.
+        
+        Parameters
+        ----------
+        column_input : string or None, default=None
+            Name of the column on 'df_period_cohorts' with the values to add.
+            
+        column_id : string or None, default=None
+            Name of the column on 'df_period_cohorts' with the unique users ids.
+        """
+        
+        aggs={}
+        for name,column,func in [('total',column_input,'sum'),('unique_users',column_id,'nunique')]:
+            if column and (name not in self.df_cohorts.columns or self._base.get(name)!=column):
+                aggs[name]=(column,func)
+        if not aggs:
+            return
+        
+        df=self.df_period_cohort
+        df_cohorts=self.df_cohorts
+        
+        # aggregate on the integer (cohort, period) key: sums are a weighted bincount over it,
+        # unique users still need a groupby. Pairs without rows stay NaN.
+        n_periods=len(df_cohorts['period'].cat.categories)
+        n_keys=n_periods*n_periods
+        key=df_cohorts['cohort'].cat.codes.values.astype(np.int64)*n_periods+df_cohorts['period'].cat.codes.values
+        rows=self._period_cohort_key
+        found=np.bincount(rows,minlength=n_keys)[key]>0
+        for name,(column,func) in aggs.items():
+            # only the column read is taken in the order of the key
+            column_values=df[column].values[self._period_cohort_rows]
+            if func=='sum':
+                # NaN adds nothing, as it was skipped by the groupby sum
+                column_values=column_values.astype(float)
+                column_values=np.where(np.isnan(column_values),0,column_values)
+                values=np.bincount(rows,weights=column_values,minlength=n_keys)[key]
+            else:
+                values=pd.Series(column_values).groupby(rows,sort=False).nunique().reindex(key).values
+            df_cohorts[name]=np.where(found,values,np.nan)
+        
+        first=self._gb_cohort()[list(aggs)].transform('first')
+        for name,(column,func) in aggs.items():
+            df_cohorts['perc_{}'.format(name)]=df_cohorts[name]/first[name]
+            self._base[name]=column
+        
+        self.df_cohorts=df_cohorts
+        self._pivot_cache={}
         
     def apply_unique_users(self,column_id):
         """
@@ -143,13 +205,7 @@ class Cohorts(object):
             raise ValueError('This function can only be executed after fit.')
         """
         
-        df=self.df_period_cohort
-        df_cohorts=self.df_cohorts.set_index(['cohort','period'])
-                
-        df_cohorts['unique_users']=df.groupby(['cohort','period'])[column_id].nunique()
-        df_cohorts=df_cohorts.reset_index().groupby('cohort').apply(perc,name='perc_{}'.format('unique_users'),column='unique_users')
-                
-        self.df_cohorts=df_cohorts
+        self._materialize_base(column_id=column_id)
         
         
     def apply_total(self,column_input):
@@ -173,13 +229,7 @@ class Cohorts(object):
             raise ValueError('This function can only be executed after fit.')
         """
         
-        df=self.df_period_cohort
-        df_cohorts=self.df_cohorts.set_index(['cohort','period'])
-                
-        df_cohorts['total']=df.groupby(['cohort','period'])[column_input].sum()
-        df_cohorts=df_cohorts.reset_index().groupby('cohort').apply(perc,name='perc_{}'.format('total'),column='total')
-                
-        self.df_cohorts=df_cohorts
+        self._materialize_base(column_input=column_input)
         
     
     def apply_churn_total(self,column_input):
@@ -210,10 +260,12 @@ class Cohorts(object):
         
         df_cohorts=self.df_cohorts
                 
-        df_cohorts=df_cohorts.groupby('cohort').apply(churn,name='churn_total',column='total')
-        df_cohorts=df_cohorts.groupby('cohort').apply(perc,name='perc_{}_total'.format('churn'),column='churn_total',column2='total')
+        first=self._gb_cohort()['total'].transform('first')
+        df_cohorts['churn_total']=first-df_cohorts['total']
+        df_cohorts['perc_churn_total']=df_cohorts['churn_total']/first
         
         self.df_cohorts=df_cohorts
+        self._pivot_cache={}
         
     def apply_churn_unique_users(self,column_id):
         """
@@ -240,14 +292,16 @@ class Cohorts(object):
         
         
         if 'unique_users' not in self.df_cohorts.columns:
-            self.apply_unique(column_id)
+            self.apply_unique_users(column_id)
         
         df_cohorts=self.df_cohorts
                 
-        df_cohorts=df_cohorts.groupby('cohort').apply(churn,name='churn_unique',column='unique_users')
-        df_cohorts=df_cohorts.groupby('cohort').apply(perc,name='perc_{}_unique'.format('churn'),column='churn_unique',column2='unique_users')
+        first=self._gb_cohort()['unique_users'].transform('first')
+        df_cohorts['churn_unique']=first-df_cohorts['unique_users']
+        df_cohorts['perc_churn_unique']=df_cohorts['churn_unique']/first
         
         self.df_cohorts=df_cohorts
+        self._pivot_cache={}
         
     def apply_accum(self,column_input):
         """
@@ -281,10 +335,12 @@ class Cohorts(object):
         
         df_cohorts=self.df_cohorts
                 
-        df_cohorts=df_cohorts.groupby('cohort').apply(accum,name='accum',column='total')
-        df_cohorts=df_cohorts.groupby('cohort').apply(perc,name='perc_{}'.format('accum'),column='accum',column2='total')
+        gb=self._gb_cohort()['total']
+        df_cohorts['accum']=gb.cumsum()
+        df_cohorts['perc_accum']=df_cohorts['accum']/gb.transform('first')
         
         self.df_cohorts=df_cohorts
+        self._pivot_cache={}
         
         
     def apply_per_user(self,column_input,column_id):
@@ -318,17 +374,15 @@ class Cohorts(object):
             raise ValueError('This function can only be executed after fit.')
         """
         
-        if 'total' not in self.df_cohorts.columns:
-            self.apply_total(column_input)
-            
-        if 'unique_users' not in self.df_cohorts.columns:
-            self.apply_unique_users(column_id)
+        self._materialize_base(None if 'total' in self.df_cohorts.columns else column_input,
+                               None if 'unique_users' in self.df_cohorts.columns else column_id)
             
         df_cohorts=self.df_cohorts
         df_cohorts['per_user']=df_cohorts['total']/df_cohorts['unique_users']
-        df_cohorts=df_cohorts.groupby('cohort').apply(perc,name='perc_{}'.format('per_user'),column='per_user')
+        df_cohorts['perc_per_user']=df_cohorts['per_user']/self._gb_cohort()['per_user'].transform('first')
         
         self.df_cohorts=df_cohorts
+        self._pivot_cache={}
         
     def apply_personalized(self,df_cohorts,column_label):
         """
@@ -348,7 +402,8 @@ class Cohorts(object):
         -------
         self
             Adds a columns column_label and perc_{column_label} to 'df_cohorts' attribute.
-            Adds the new parameter to 'arguments' attribute.
+            Adds the new parameter to 'arguments' attribute. Cohorts and periods not already
+            on 'df_cohorts' attribute are ignored.
             
         Note
         ----
@@ -360,15 +415,14 @@ class Cohorts(object):
             raise ValueError('This function can only be executed after fit.')
         """
         
-        df_cohorts=pd.merge(self.df_cohorts,df_cohorts[['cohort','period',column_label]],on=['cohort','period'],how='outer')
-        df_cohorts=df_cohorts.groupby('cohort').apply(perc,name='perc_{}'.format(column_label),column=column_label)
+        period_type=self.df_cohorts['period'].dtype
+        df_cohorts=df_cohorts[['cohort','period',column_label]].astype({'cohort':period_type,'period':period_type})
+        self.df_cohorts=self.df_cohorts.join(df_cohorts.set_index(['cohort','period']),on=['cohort','period'],how='left')
+        self.df_cohorts['perc_{}'.format(column_label)]=self.df_cohorts[column_label]/self._gb_cohort()[column_label].transform('first')
+        self._pivot_cache={}
         
-        self.df_cohorts=df_cohorts
-        
-        _args=self.arguments
-        _args.append(column_label)
-        _args=set(_args)
-        self.arguments=list(_args)
+        if column_label not in self.arguments:
+            self.arguments.append(column_label)
         
         
     def fit(self,data,column_date,column_id,column_input=None,how=[]):
@@ -404,31 +458,54 @@ class Cohorts(object):
         if not self.simple and not column_input:
             raise ValueError("simple = False requires argument 'column_input'")
         else:
-            df=deepcopy(data)
-            df['unique_id']=np.arange(len(df))
+            # shallow copy: fit only adds columns, it never writes into the existing ones
+            df=data.copy(deep=False)
             
             if self.simple:
                 column_input='column_input'
                 df[column_input]=1
                 
-            df['period']=df[column_date].apply(lambda x: custom_representative(self.period,x))
+            df['period']=series_representative(self.period,df[column_date])
 
             df.set_index(column_id,inplace=True)
             df['cohort']=df.groupby(level=0)['period'].min()
             df=df.reset_index()
             
+            # rows without a date or a user have no (cohort, period) and are left out of the
+            # aggregations, as the groupbys did
+            keep=(df['period'].notna()&df['cohort'].notna()).values
+            periods=np.unique(df['period'].values[keep])
             
+            # integer (cohort, period) key of the rows kept, codes are positions on 'periods'. Only the
+            # key and the row positions are sorted by it, once, so the groupbys on it don't need to
+            # sort again and 'df_period_cohort' is never copied
+            key=np.searchsorted(periods,df['cohort'].values[keep])*len(periods)+np.searchsorted(periods,df['period'].values[keep])
+            order=np.argsort(key,kind='stable')
             self.df_period_cohort=df
+            self._period_cohort_rows=np.flatnonzero(keep)[order]
+            self._period_cohort_key=key[order]
+            
+            # every cohort is paired with all the periods from its own one onwards
+            cohort_starts=np.unique(df['cohort'].values[keep])
+            starts=np.searchsorted(periods,cohort_starts)
+            cohorts=pd.DataFrame({'cohort':np.repeat(cohort_starts,len(periods)-starts),
+                                  'period':np.concatenate([periods[i:] for i in starts])})
+            cohorts['period_num']=cohorts.groupby('cohort',sort=False).cumcount()
             
-            cohorts=df.groupby(['cohort','period'])[[column_input]].count().rename(columns={column_input:'centinela'})
-            cohorts=cohorts.unstack().fillna(0).stack().reset_index()
-            cohorts=cohorts[cohorts['cohort']<=cohorts['period']]
-            cohorts=cohorts.groupby('cohort').apply(nums)
+            self.period_list=list(series_period(self.period,cohorts['period']).unique())
+            self.cohort_list=list(series_period(self.period,cohorts['cohort']).unique())
             
-            self.period_list=list(cohorts['period'].apply(lambda x: custom_period(self.period,x)).unique())
-            self.cohort_list=list(cohorts['cohort'].apply(lambda x: custom_period(self.period,x)).unique())
+            # shared ordered categories so later groupbys on 'cohort' and 'period' work on integer codes
+            period_type=pd.CategoricalDtype(categories=periods,ordered=True)
+            for column in ['cohort','period']:
+                cohorts[column]=cohorts[column].astype(period_type)
             
             self.df_cohorts=cohorts[['cohort','period','period_num']]
+            self._base={}
+            self._pivot_cache={}
+            self.column_id=column_id
+            self.column_date=column_date
+            self.column_input=column_input
                         
             dic={'total': self.apply_total,
                  'churn_total': self.apply_churn_total,
@@ -447,9 +524,9 @@ class Cohorts(object):
                 else:
                     raise ValueError("How values should be inside some of these: 'total','churn_total','accum','unique_users','churn_unique_users','per_user'")
             
-            self.arguments=list(set(how+self.arguments))
-            self.column_id=column_id
-            self.column_date=column_date
+            for item in how:
+                if item not in self.arguments:
+                    self.arguments.append(item)
             
     def transform_pd(self,label,way='period'):
         """
@@ -468,8 +545,8 @@ class Cohorts(object):
         pandas DataFrame with the cohorts as index and 'way' as columns containing the label values
 
         """
-        df_cohorts=self.df_cohorts.set_index(['cohort',way])[[label]].unstack()
-        return df_cohorts
+        # a copy, so the caller can't change the cached pivot
+        return self._pivot(label,way).copy()
     
     def transform_np(self,label,way='period'):
         """
@@ -491,7 +568,7 @@ class Cohorts(object):
         
         numpy_cohorts : numpy arry of shape (len(way),len(periods))
         """
-        numpy_cohorts=np.array(self.df_cohorts.set_index(['cohort',way])[[label]].unstack())
+        numpy_cohorts=np.array(self._pivot(label,way))
         list_periods=np.array(self.df_cohorts[way].unique())
         list_cohorts=np.array(self.df_cohorts['cohort'].unique())
         return list_periods,list_cohorts,numpy_cohorts
@@ -524,9 +601,9 @@ class Cohorts(object):
         if 'unique_users' not in self.df_cohorts.columns:
             self.apply_unique_users(self.column_id)
             
-        cohort_size=self.df_cohorts.groupby('cohort')[['unique_users']].apply(lambda x: x.iloc[0]).rename(columns={'unique_users':'cohort_size'})
+        cohort_size=self._gb_cohort()[['unique_users']].first().rename(columns={'unique_users':'cohort_size'})
         
-        df_coh=self.df_cohorts.set_index(['cohort',way])[label].unstack()
+        df_coh=self._pivot(label,way)[label]
         
         ## prepare the plot
         max_coh=round(len(self.df_cohorts['cohort'].unique())*0.75)
@@ -546,7 +623,7 @@ class Cohorts(object):
                        cmap='coolwarm_r',
                        annot=True,fmt='.0f',
                        ax=ax2)
-        elif self.df_cohorts[label].mean()<5:
+        elif self.df_cohorts[label].head(1024).mean()<5: # a sample is enough to pick the format
             ax=sns.heatmap(df_coh,
                        cmap='coolwarm_r',
                        annot=True,fmt='.3f',
@@ -609,18 +686,16 @@ class Cohorts(object):
         df_cohorts=self.df_cohorts
         # 'age' means every line is a period num and cohorts are on the x-axis
         if way=='age':
-            for num in df_cohorts['period_num'].unique():
-                dat=df_cohorts.loc[df_cohorts['period_num']==num,['cohort',label]]
+            for num,dat in df_cohorts[['cohort',label]].groupby(df_cohorts['period_num'],sort=False):
                 plt.plot(dat['cohort'],dat[label],label=num)
                 
         #age means every line is a period num and cohorts are on the x-axis
         else:
         
-            for i,cohort in enumerate(df_cohorts['cohort'].unique()):
-                dat=df_cohorts.loc[df_cohorts['cohort']==cohort,[way,label]]
+            for i,(cohort,dat) in enumerate(self._gb_cohort()[[way,label]]):
                 plt.plot(dat[way],dat[label],label=self.cohort_list[i])
 
-            plt.plot(df_cohorts[way].unique(),df_cohorts.set_index(['cohort',way])[[label]].unstack().mean().values,'k--',label='mean')
+            plt.plot(df_cohorts[way].unique(),self._pivot(label,way).mean().values,'k--',label='mean')
             
         if label[:4]=='perc':
             ticks,labels=plt.yticks()
@@ -9,11 +9,21 @@ import numpy as np
 import matplotlib.pyplot as plt
 import datetime as dt
 
-from copy import deepcopy
 
 from aux import *
 
 
+# outputs of the fit, in the order of the rows of GrowthAccounting._values
+_OUTPUTS=('total','new','resurrected','expansion','contraction','retained','churned',
+          'new_rate','resurrected_rate','expansion_rate','contraction_rate','retained_rate','churned_rate',
+          'growth_rate','gross_retention','quick_ratio','net_churn')
+
+def _output(name):
+    # view over the row of 'name' in the fitted buffer
+    row=_OUTPUTS.index(name)
+    return property(lambda self: self._values[row])
+
+
 class GrowthAccounting(object):
     """
     GrowthAccounting is an object implementation of the Growth Accounting Framework. The framework
@@ -45,6 +55,10 @@ class GrowthAccounting(object):
         unit (ex. revenue) and we need the columns on simple but also a 'quantity' column to 
         build the framework.
         
+    validate : bool, default=False
+        Used to check on fit that the growth components add up to the total of each period
+        and of the period before. It's meant for debugging, so it's off by default.
+        
     
     Attributes
     ----------
@@ -52,6 +66,8 @@ class GrowthAccounting(object):
     
     simple : the simple input (see on Parameters section)
     
+    validate : the validate input (see on Parameters section)
+    
     period_rep_list : nparray of datetime objects
         Each period ocurrs between the date in this list and the date in this list + period (attribute).
         It uses the first day as the representative of the whole period.
@@ -130,7 +146,27 @@ class GrowthAccounting(object):
         https://tribecap.co/a-quantitative-approach-to-product-market-fit/
     """
     
-    def __init__(self,period='M',simple=True):
+    total=_output('total')
+    new=_output('new')
+    resurrected=_output('resurrected')
+    expansion=_output('expansion')
+    contraction=_output('contraction')
+    retained=_output('retained')
+    churned=_output('churned')
+    
+    new_rate=_output('new_rate')
+    resurrected_rate=_output('resurrected_rate')
+    expansion_rate=_output('expansion_rate')
+    contraction_rate=_output('contraction_rate')
+    retained_rate=_output('retained_rate')
+    churned_rate=_output('churned_rate')
+    
+    growth_rate=_output('growth_rate')
+    gross_retention=_output('gross_retention')
+    quick_ratio=_output('quick_ratio')
+    net_churn=_output('net_churn')
+    
+    def __init__(self,period='M',simple=True,validate=False):
         _period=period.lower()
         
         if _period not in ['m','q','d','28d','7d']:
@@ -139,6 +175,7 @@ class GrowthAccounting(object):
             self.period=_period
             
         self.simple=simple
+        self.validate=validate
         
     
     def fit(self,data,column_date,column_id,column_input=None):
@@ -173,106 +210,111 @@ class GrowthAccounting(object):
         
         else:
             print('Preparing the data...')
-            df=deepcopy(data)
-            df['unique_id']=np.arange(len(df))
+            # only the columns fit reads, shallow: the new columns never write into 'data'
+            df=data[[column_date,column_id]+([] if self.simple else [column_input])].copy(deep=False)
             
             if self.simple:
                 column_input='column_input'
                 df[column_input]=1
                 
-            df['period_rep']=df[column_date].apply(lambda x: custom_representative(self.period,x))
+            # users and periods as int32 codes, the periods sorted as ordered categories, so the sort
+            # below works on integers. Rows without id or date are left out, as the groupbys did.
+            # Periods are taken on the local dates, tz-aware ones are not moved to UTC.
+            uid=pd.factorize(df[column_id])[0]
+            period_code,periods=pd.factorize(series_representative(self.period,df[column_date]),sort=True)
+            keep=(uid>=0)&(period_code>=0)
+            uid=uid[keep].astype(np.int32)
+            period_code=period_code[keep].astype(np.int32)
 
-            df.set_index(column_id,inplace=True)
-            df['cohort_rep']=df.groupby(level=0)['period_rep'].min()
-            df=df.reset_index()
+            # a single sort by user and period serves every per-user step below: each (user, period)
+            # pair is a contiguous run of rows and the first run of each user is its cohort
+            order=np.lexsort((period_code,uid))
+            uid=uid[order]
+            period_code=period_code[order]
+            quantity=df[column_input].values[keep][order].astype(float)
+            pair_start=np.flatnonzero(np.r_[True,(uid[1:]!=uid[:-1])|(period_code[1:]!=period_code[:-1])])
+            pair_uid=uid[pair_start]
+            pair_period=period_code[pair_start]
+            pair_freq=np.diff(np.r_[pair_start,len(order)])
+            pair_revenue=np.add.reduceat(np.where(np.isnan(quantity),0,quantity),pair_start)
             
-            df_users=df.groupby([column_id,'cohort_rep','period_rep'])[['unique_id']].count().rename(columns={'unique_id':'freq'})
-            df_users=df_users.unstack().fillna(0).stack().reset_index()
-            df_users=df_users[df_users['period_rep']>=df_users['cohort_rep']]
-            df_users['freq']=df_users['freq'].astype(int)
-            df_users['uniques']=df_users['freq'].apply(lambda x: np.where(x>0,1,0))
-
-            def user_change(df):
-                df['change']=df['uniques'].diff()
-                return df
-
-            df_users=df_users.groupby([column_id,'cohort_rep']).apply(user_change)
-            df_users['change']=df_users['change'].fillna(2)
-            df_users['supercolumn']=df_users['change']+df_users['uniques']
+            user_first=np.r_[True,pair_uid[1:]!=pair_uid[:-1]]
+            cohort_code=pair_period[user_first]
             
-            df_revenue=df_users[[column_id,'cohort_rep','period_rep','supercolumn']].set_index([column_id,'period_rep'])
-            df_revenue['revenue']=df.groupby([column_id,'period_rep'])[column_input].sum()
-            df_revenue['revenue']=df_revenue['revenue'].fillna(0)
-            df_revenue=df_revenue.reset_index()
-
-            def revenue_change(df):
-                df['revchange']=df['revenue'].diff()
-                return df
-
-            df_revenue=df_revenue.groupby([column_id,'cohort_rep']).apply(revenue_change)
-            df_revenue['revstatus']=df_revenue['revchange'].apply(lambda x: np.where(x>0,1,np.where(x<0,-1,0)))
-            df_revenue['retained']=df_revenue['revenue']-df_revenue['revchange'].apply(lambda x: np.where(x<0,0,x))
+            # shift and count over the active pairs only: a pair continues its user's previous one
+            # when that was on the period right before, and a pair nobody continues churns its
+            # revenue on the next period (unless it's already the last one)
+            continued=np.r_[False,pair_period[1:]==pair_period[:-1]+1]&~user_first
+            revchange=np.r_[pair_revenue[:1],np.diff(pair_revenue)]
+            churn=~np.r_[continued[1:],False]&(pair_period<len(periods)-1)
             
             print('Computing Growth Accounting...')
-            dfgrowth=df.groupby(['cohort_rep'])[[column_id]].nunique().rename(columns={column_id:'new_ids'})
-            dfgrowth['total_ids']=df.groupby(['period_rep'])[[column_id]].nunique()
-            dfgrowth['total_orders']=df.groupby(['period_rep'])[[column_id]].count()
+            # users, active users and actions per period straight from the sorted pairs;
+            # periods without new users are left out as they have no cohort
+            new_ids=np.bincount(cohort_code,minlength=len(periods))
+            dfgrowth=pd.DataFrame({'new_ids':new_ids,
+                                   'total_ids':np.bincount(pair_period,minlength=len(periods)),
+                                   'total_orders':np.bincount(pair_period,weights=pair_freq,minlength=len(periods)).astype(np.int64)},
+                                  index=pd.Index(periods,name='cohort_rep'))[new_ids>0]
             
-            dfgrowth['new']=df_revenue[df_revenue['supercolumn']==3].groupby('period_rep')['revenue'].sum()
-            dfgrowth['resurrected']=df_revenue[df_revenue['supercolumn']==2].groupby('period_rep')['revenue'].sum()
-            dfgrowth['expansion']=df_revenue[(df_revenue['supercolumn']==1)&(df_revenue['revstatus']==1)].groupby('period_rep')['revchange'].sum()
-            dfgrowth['contraction']=df_revenue.loc[(df_revenue['supercolumn']==1)&(df_revenue['revstatus']==-1)].groupby('period_rep')['revchange'].sum()
-            dfgrowth['retained']=df_revenue.loc[(df_revenue['supercolumn']==1)].groupby('period_rep')['retained'].sum()
-            dfgrowth['churned']=df_revenue.loc[(df_revenue['supercolumn']==-1)].groupby('period_rep')['revchange'].sum()
-
-            dfgrowth=dfgrowth.fillna(0)
+            # every event falls in one int8 bucket: new, resurrected, expansion, contraction, churned
+            # or none of them, so a single bincount over (period, bucket) sums all the components
+            bucket=np.select([user_first,~continued,revchange>0,revchange<0],[0,1,2,3],5).astype(np.int8)
+            code=np.r_[pair_period*6+bucket,(pair_period[churn]+1)*6+4]
+            value=np.r_[np.where(bucket<2,pair_revenue,revchange),-pair_revenue[churn]]
+            sums=np.bincount(code,weights=value,minlength=len(periods)*6).reshape(len(periods),6)
+            parts=pd.DataFrame(sums[:,:5],index=pd.Index(periods,name='period_rep'),
+                               columns=['new','resurrected','expansion','contraction','churned'])
+            retained=np.where(continued,pair_revenue-np.clip(revchange,0,None),0)
+            parts['retained']=np.bincount(pair_period,weights=retained,minlength=len(periods))
+            parts['total']=np.bincount(pair_period,weights=pair_revenue,minlength=len(periods))
+            parts=parts[['new','resurrected','expansion','contraction','retained','churned','total']]
             
-            dfgrowth['total']=df_revenue.groupby('period_rep')['revenue'].sum()
-            dfgrowth['total_rev2']=dfgrowth['new']+dfgrowth['retained']+dfgrowth['expansion']+dfgrowth['resurrected']
-            dfgrowth['total_rev-1']=dfgrowth['retained']-dfgrowth['churned']-dfgrowth['contraction']
+            if self.validate:
+                # the components must rebuild the total of the period and the one of the period before
+                period_total=parts['total'].values
+                total_rev2=(parts['new']+parts['retained']+parts['expansion']+parts['resurrected']).values
+                total_rev1=(parts['retained']-parts['churned']-parts['contraction']).values
+                assert np.allclose(total_rev2,period_total), "components don't add up to the period total"
+                assert np.allclose(total_rev1[1:],period_total[:-1]), "components don't add up to the previous period total"
             
+            dfgrowth=dfgrowth.join(parts)
             
-            dfgrowth['new_rate']=dfgrowth['new']/dfgrowth['new'].shift(1)
-            dfgrowth['resurrected_rate']=dfgrowth['resurrected']/dfgrowth['resurrected'].shift(1)
-            dfgrowth['expansion_rate']=dfgrowth['expansion']/dfgrowth['expansion'].shift(1)
-            dfgrowth['contraction_rate']=dfgrowth['contraction']/dfgrowth['contraction'].shift(1)
-            dfgrowth['retained_rate']=dfgrowth['retained']/dfgrowth['retained'].shift(1)
-            dfgrowth['churned_rate']=dfgrowth['churned']/dfgrowth['churned'].shift(1)
+            dfgrowth=dfgrowth.fillna(0)
+            
+            # change of every component against the previous period, all in one array division.
+            # The array is column-major so each component is contiguous for the column-wise ops.
+            components=['new','resurrected','expansion','contraction','retained','churned','total']
+            values=np.asfortranarray(dfgrowth[components].to_numpy(dtype=float))
+            new,resurrected,expansion,contraction,retained,churned,total=values.T
+            rates=np.full(values.shape,np.nan,order='F')
+            with np.errstate(divide='ignore',invalid='ignore'):
+                rates[1:]=values[1:]/values[:-1]
+                growth_rate=rates[:,0]+rates[:,1]+rates[:,2]-rates[:,3]-rates[:,5]
+                gross_retention=retained[1:]/total[:-1]
+                quick_ratio=(new+resurrected+expansion)/(-churned-contraction)
+                net_churn=(-churned-contraction-resurrected-expansion)[1:]/total[:-1]
+            dfgrowth[[name+'_rate' for name in components[:-1]]]=rates[:,:-1]
             
-            dfgrowth['growth_rate']=dfgrowth['new_rate']+dfgrowth['resurrected_rate']+dfgrowth['expansion_rate']-dfgrowth['contraction_rate']-dfgrowth['churned_rate']
-            dfgrowth['gross_retention']=dfgrowth['retained']/dfgrowth['total'].shift(1)
-            dfgrowth['quick_ratio']=(dfgrowth['new']+dfgrowth['resurrected']+dfgrowth['expansion'])/(-dfgrowth['churned']-dfgrowth['contraction'])
-            dfgrowth['net_churn']=(-dfgrowth['churned']-dfgrowth['contraction']-dfgrowth['resurrected']-dfgrowth['expansion'])/(dfgrowth['total'].shift(1))
+            dfgrowth['growth_rate']=growth_rate
+            dfgrowth['gross_retention']=np.concatenate([[np.nan],gross_retention])
+            dfgrowth['quick_ratio']=quick_ratio
+            dfgrowth['net_churn']=np.concatenate([[np.nan],net_churn])
             
             dfgrowth=dfgrowth.replace(np.inf, np.nan).replace(-np.inf, np.nan)
             # dfgrowth=dfgrowth.fillna(0) #this falsifies the data
             
             self.period_rep_list=np.array(dfgrowth.index)
-            self.period_list=np.array(pd.Series(dfgrowth.index).apply(lambda x: custom_period(self.period,x)))
-            
-            self.total=np.array(dfgrowth['total'])
-            self.new=np.array(dfgrowth['new'])
-            self.resurrected=np.array(dfgrowth['resurrected'])
-            self.expansion=np.array(dfgrowth['expansion'])
-            self.contraction=np.array(dfgrowth['contraction'])
-            self.retained=np.array(dfgrowth['retained'])
-            self.churned=np.array(dfgrowth['churned'])
-            
-            self.new_rate=np.array(dfgrowth['new_rate'])
-            self.resurrected_rate=np.array(dfgrowth['resurrected_rate'])
-            self.expansion_rate=np.array(dfgrowth['expansion_rate'])
-            self.contraction_rate=np.array(dfgrowth['contraction_rate'])
-            self.retained_rate=np.array(dfgrowth['retained_rate'])
-            self.churned_rate=np.array(dfgrowth['churned_rate'])
+            self.period_list=np.array(series_period(self.period,pd.Series(dfgrowth.index)))
             
-            self.growth_rate=np.array(dfgrowth['growth_rate'])
-            self.gross_retention=np.array(dfgrowth['gross_retention'])
-            self.quick_ratio=np.array(dfgrowth['quick_ratio'])
-            self.net_churn=np.array(dfgrowth['net_churn'])
+            # all the outputs share one buffer, one contiguous row per output (see _OUTPUTS)
+            self._values=np.ascontiguousarray(dfgrowth[list(_OUTPUTS)].to_numpy().T)
             
             self.df=dfgrowth[['total','new','resurrected','expansion','contraction','retained','churned',
                              'new_rate','resurrected_rate','expansion_rate','retained_rate','churned_rate',
-                             'growth_rate','gross_retention','quick_ratio','net_churn']]
+                             'growth_rate','gross_retention','quick_ratio','net_churn']].copy()
+            # the copy holds only its own columns, so the working ones go away with dfgrowth
+            del dfgrowth
             
             print('Done!')
             
@@ -294,7 +336,7 @@ class GrowthAccounting(object):
 
         """
         label='C{}GR{}'.format(self.period,num_periods).upper()
-        self.df[label]=(self.df['total']/self.df['total'].shift(num_periods)).apply(lambda x: x**(1/num_periods)-1)
+        self.df[label]=np.power(self.df['total']/self.df['total'].shift(num_periods),1/num_periods)-1
         return np.array(self.df[label])
     
     def plot_compound_growth(self,num_periods):
@@ -316,7 +358,7 @@ class GrowthAccounting(object):
 
         """
         label='C{}GR{}'.format(self.period,num_periods).upper()
-        self.df[label]=(self.df['total']/self.df['total'].shift(num_periods)).apply(lambda x: x**(1/num_periods)-1)
+        self.df[label]=np.power(self.df['total']/self.df['total'].shift(num_periods),1/num_periods)-1
         comp = np.array(self.df[label])    
     
         fig,ax1=plt.subplots(1,1,figsize=(15,5))